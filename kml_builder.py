@@ -1,14 +1,24 @@
-from datetime import date
-import base64
-import gpxpy
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+import array
+import calendar
+import functools
+import hashlib
+import math
 import numpy as np
-import json
-import rdp
+import orjson
+import os
+import pickle
 import re
+import shutil
+import xml.etree.ElementTree as etree
+from urllib.parse import quote
+import zipfile
 
 # Required Python packages:
-# - gpxpy
-# - rdp
+# - numpy
+# - orjson
 
 # TODO: Create s separate kml file for every year (via some filtering options).
 # TODO: Validate URLs to photos and tracks.
@@ -29,14 +39,27 @@ import re
 # displayed.
 
 kml_title = "Cheryl &amp; Stefan's Outings"
+# Either a json array or newline-delimited json (".ndjson", one outing per
+# line).
 input_json_file = "outings.json"
 ouptut_kml_file = "map.lienhard.io.kml"
+# Same content zipped as doc.kml. The plain kml is still needed for the
+# leaflet and OpenLayers versions which parse it themselves.
+output_kmz_file = "map.lienhard.io.kmz"
 
 gpx_data_dir = "data/"
+linestring_cache_file = ".cache/linestrings.pickle"
+# NOTE: Bump this after changing the code in _process_gpx() so that stale
+# cache entries aren't used anymore. Changes to the templates, the precision,
+# or the RDP epsilon are picked up automatically (see generate_linestrings()).
+linestring_cache_version = 1
 photo_base_url = "https://stefalie.smugmug.com/"
 strava_base_url = "https://www.strava.com/activities/"
 
 rdp_epsilon = 0.0002
+# Decimal places of the written coordinates. One more digit than the RDP
+# tolerance is plenty, anything beyond that just bloats the kml.
+coord_precision = max(4, -int(math.floor(math.log10(rdp_epsilon))) + 1)
 
 line_width = 8
 marker_icon_size = 48
@@ -56,143 +79,266 @@ styles = {
         "XC-Ski"      : (  0, 227, 216, alpha),  # Turqoise
 }
 
-with open(input_json_file, "r", encoding="utf8") as in_file:
-    outings = json.load(in_file)
+# NOTE: The templates already contain the indentation they end up with in the
+# kml file. Only the geometries are indented when writing them (see
+# write_indented()) because the same <LineString> can appear at different
+# depths.
 
-def indent(template_str, indent):
-    lines = template_str.split("\n")
-    lines = map(lambda x : (indent * "\t") + x, lines)
-    return "\n".join(lines)
-
-template_body = '''
+# The styles and placemarks are written one by one between the header and the
+# footer.
+template_header = '''
 <?xml version="1.0" encoding="utf-8"?>
 <kml xmlns="http://www.opengis.net/kml/2.2">
 	<Document>
 		<name>{kml_title}</name>
-{styles}
-{placemarks}
+'''.lstrip()
+template_footer = '''
 	</Document>
 </kml>
-'''.strip()
+'''.lstrip("\n").rstrip()
 template_style = '''
-<Style id="{style_name}">
-	<LineStyle>
-		<color>{color}</color>
-		<width>{width}</width>
-	</LineStyle>
-	<IconStyle>
-		<Icon>
-			<href>{icon_url}</href>
-		</Icon>
-		<hotSpot x="0.5" y="0.0" xunits="fraction" yunits="fraction"/>
-	</IconStyle>
-</Style>
-'''.strip()
+		<Style id="{style_name}">
+			<LineStyle>
+				<color>{color}</color>
+				<width>{width}</width>
+			</LineStyle>
+			<IconStyle>
+				<Icon>
+					<href>{icon_url}</href>
+				</Icon>
+				<hotSpot x="0.5" y="0.0" xunits="fraction" yunits="fraction"/>
+			</IconStyle>
+		</Style>
+'''.lstrip("\n")
 # NOTE: We don't use the <name> tag for <Placemark>s because geo admin will
 # dsipaly it on the map for <Point>s (not for <LineString>). I don't know how
 # to hide it. Instead we put the name/title into the description.
-template_placemark = '''
-<Placemark>
-	<styleUrl>#{style_name}</styleUrl>
-	<description><![CDATA[{description}]]></description>
-{geometry}
-</Placemark>
-'''.strip()
+# The geometries go between the begin and end of a placemark.
+template_placemark_begin = '''
+		<Placemark>
+			<styleUrl>#{style_name}</styleUrl>
+			<description><![CDATA[{description}]]></description>
+'''.lstrip("\n")
+template_placemark_end = "\t\t</Placemark>\n"
 # NOTE: <MultiGeometry> is suboptimal for geo admin for <LineString>s as it
 # disables the display for the elevation profile.
-template_multigeometry = '''
-<MultiGeometry>
-{geometries}
-</MultiGeometry>
-'''.strip()
-template_coordinate = "{long:.5f},{lat:.5f}"
-template_point = '''
+template_multigeometry_begin = "\t\t\t<MultiGeometry>\n"
+template_multigeometry_end = "\t\t\t</MultiGeometry>\n"
+# The geometry templates are split around their only field and concatenated
+# (instead of going through str.format).
+template_coordinate_part = f"%.{coord_precision}f"
+template_coordinate = template_coordinate_part + "," + template_coordinate_part  # long,lat
+template_point_begin = '''
 <Point>
 	<altitudeMode>clampToGround</altitudeMode>
-	<coordinates>{coordinate}</coordinates>
-</Point>
-'''.strip()
-template_linestring = '''
+	<coordinates>'''.lstrip("\n")
+template_point_end = '''</coordinates>
+</Point>'''
+template_linestring_begin = '''
 <LineString>
 	<altitudeMode>clampToGround</altitudeMode>
 	<tessellate>1</tessellate>
-	<coordinates>{coordinates}</coordinates>
-</LineString>
-'''.strip()
+	<coordinates>'''.lstrip("\n")
+template_linestring_end = '''</coordinates>
+</LineString>'''
 
 # Icon marker
 # Copied base64 data from https://thenounproject.com/term/map-marker/5624/ and
 # passed it through https://jakearchibald.github.io/svgomg/.
 # Unfortunately the <color> tags inside <IconStyle> seem to be ignored on geo
 # admin, therefore we replicate the svg icon for the different fill colors.
-marker_icon_svg = '<svg height="{size}" width="{size}" xmlns="http://www.w3.org/2000/svg" viewBox="0 0 100 100"><path fill="rgba({r},{g},{b},{a})" d="M50 14a24 24 0 00-24 24c0 13.3 24 48 24 48s24-34.8 24-48a24 24 0 00-24-24zm0 36.5a12 12 0 110-24 12 12 0 010 24z"/></svg>'
-
-def svg_base64_data_url(color):
+# The svg uses single quotes so that it can be put into a data URL mostly
+# unescaped.
+marker_icon_svg = "<svg height='{size}' width='{size}' xmlns='http://www.w3.org/2000/svg' viewBox='0 0 100 100'><path fill='rgba({r},{g},{b},{a})' d='M50 14a24 24 0 00-24 24c0 13.3 24 48 24 48s24-34.8 24-48a24 24 0 00-24-24zm0 36.5a12 12 0 110-24 12 12 0 010 24z'/></svg>"
+
+# NOTE: Percent-encoding everything would make the URL longer than base64, so
+# only the characters that need it (mostly '<' and '>') get encoded.
+# Styles often share the same color (e.g. "Hike" and "ViaFerrata").
+@functools.lru_cache(maxsize=None)
+def svg_data_url(color):
     marker_icon_svg_filled = marker_icon_svg.format(size=marker_icon_size, r=color[0], g=color[1], b=color[2], a=color[3])
-    marker_icon_b64 = base64.b64encode(marker_icon_svg_filled.encode("ascii"))
-    return f"data:image/svg+xml;base64,{marker_icon_b64.decode('ascii')}"
+    return "data:image/svg+xml," + quote(marker_icon_svg_filled, safe=" /=:,.()'")
 
 def kml_hex_color(c):
     # aabbggrr
     return f"{int(c[3]*255):0{2}X}{c[2]:0{2}X}{c[1]:0{2}X}{c[0]:0{2}X}"
 
 def generate_style(style):
-    return template_style.format(style_name=style[0], color=kml_hex_color(style[1]), width=line_width, icon_url=svg_base64_data_url(style[1]))
-kml_styles = "\n".join(map(generate_style, styles.items()))
+    return template_style.format(style_name=style[0], color=kml_hex_color(style[1]), width=line_width, icon_url=svg_data_url(style[1]))
+kml_styles = "".join(map(generate_style, styles.items()))
+
+def write_indented(kml_file, geometry, depth):
+    kml_file.writelines((depth * "\t") + line + "\n" for line in geometry.split("\n"))
 
 date_fmt = "([0-9]{4}-[0-9]{2}-[0-9]{2})"  # TODO: Could be more restrictive.
 type_fmt = "(" + "|".join(styles) + ")"
 title_fmt = "(\S+?)"  # Anything but whitespace
 multi_track_fmt = "(?:__(\d))?"
 track_file_format = f"^{date_fmt}__{type_fmt}__{title_fmt}{multi_track_fmt}.gpx$"
+track_file_re = re.compile(track_file_format)
+date_re = re.compile(f"^{date_fmt}$")
+
+# English month names independent of the current locale (unlike strftime).
+month_names = ("January", "February", "March", "April", "May", "June",
+               "July", "August", "September", "October", "November", "December")
+
+# Track points are kept in (n, 2) float64 arrays with one [lat, long] row per
+# point all the way from parsing the gpx file to writing the coordinates.
+TrackArray = np.ndarray
+
+# Iterative Ramer-Douglas-Peucker, equivalent to rdp.rdp(algo="iter",
+# return_mask=True) but with the distances of a whole sub-range computed in
+# one go by numpy. Returns a mask of the points to keep.
+def _rdp_mask(pts: TrackArray, eps: float) -> np.ndarray:
+    n = len(pts)
+    keep = np.zeros(n, dtype=bool)
+    if n == 0:
+        return keep
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        s, e = stack.pop()
+        if e - s < 2:
+            continue
+        seg = pts[s + 1:e]
+        line = pts[e] - pts[s]
+        line_len = np.linalg.norm(line)
+        if line_len == 0.0:
+            # Closed loop, fall back to the distance to the start point.
+            d = np.sqrt(np.sum((seg - pts[s]) ** 2, axis=1))
+        else:
+            diff = pts[s] - seg
+            d = np.abs(line[0] * diff[:, 1] - line[1] * diff[:, 0]) / line_len
+        idx = np.argmax(d)
+        if d[idx] > eps:
+            keep[s + 1 + idx] = True
+            stack.append((s, s + 1 + idx))
+            stack.append((s + 1 + idx, e))
+    return keep
 
 # Taking from https://github.com/Andrii-D/optimize-gpx/blob/master/optimize-gpx.py
 # but without splitting segments and without elevation correction (shouldn't be
 # necessary for the data from Garmin/Strava).
-def optimize_segment_rdp(seg):
-    result = gpxpy.gpx.GPXTrackSegment()
-    arr = np.array(list(map(lambda p: [p.latitude, p.longitude], seg.points)))
-    mask = rdp.rdp(arr, algo="iter", return_mask=True, epsilon=rdp_epsilon)
-    parr = np.array(seg.points)
-    result.points = list(parr[mask])
-    return result
+def optimize_segment_rdp(pts: TrackArray) -> TrackArray:
+    return pts[_rdp_mask(pts, rdp_epsilon)]
+
+gpx_ns = "{http://www.topografix.com/GPX/1/1}"
+
+# Streams through the gpx file and only extracts what we need (instead of
+# building the full object tree with gpxpy). The points of all segments are
+# concatenated in order.
+def load_trackpoints(gpx_file_name) -> TrackArray:
+    coords = array.array("d")
+    counts = {"trk": 0, "wpt": 0, "rte": 0}
+    for _, el in etree.iterparse(gpx_file_name):
+        tag = el.tag[len(gpx_ns):] if el.tag.startswith(gpx_ns) else el.tag
+        if tag == "trkpt":
+            coords.append(float(el.get("lat")))
+            coords.append(float(el.get("lon")))
+            el.clear()
+        elif tag in counts:
+            counts[tag] += 1
+    assert((counts["trk"] == 1) and
+           (counts["wpt"] == 0) and
+           (counts["rte"] == 0)), f"We expect exactly 1 track per gpx file: {gpx_file_name}"
+    return np.frombuffer(coords, dtype=np.float64).reshape(-1, 2)
+
+def _process_gpx(gpx_file_name):
+    all_points = optimize_segment_rdp(load_trackpoints(gpx_file_name))
+    # Same format as template_coordinate, but for all points in one go.
+    long_strs = np.char.mod(template_coordinate_part, all_points[:, 1])
+    lat_strs = np.char.mod(template_coordinate_part, all_points[:, 0])
+    coords = " ".join(np.char.add(np.char.add(long_strs, ","), lat_strs).tolist())
+    return template_linestring_begin + coords + template_linestring_end
+
+# Parsing and simplifying the gpx files is by far the most expensive part, so
+# it's done up front for all tracks in parallel. Results are cached on disk,
+# keyed by file content and everything else the finished <LineString> depends
+# on. That way renamed or duplicated gpx files are only processed once.
+def gpx_digest(gpx_file_name):
+    with open(gpx_file_name, "rb") as gpx_file:
+        return hashlib.blake2b(gpx_file.read(), digest_size=16).hexdigest()
+
+def generate_linestrings(tracks):
+    try:
+        with open(linestring_cache_file, "rb") as cache_file:
+            cache = pickle.load(cache_file)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        cache = {}
+
+    settings = (linestring_cache_version, rdp_epsilon, coord_precision, template_coordinate_part,
+                template_linestring_begin, template_linestring_end)
+    keys = {t: (gpx_digest(gpx_data_dir + t),) + settings for t in tracks}
+    # One (arbitrary) file name per uncached key.
+    todo = {keys[t]: t for t in tracks if keys[t] not in cache}
+    if todo:
+        with ProcessPoolExecutor() as ex:
+            results = ex.map(_process_gpx, [gpx_data_dir + t for t in todo.values()], chunksize=4)
+            for key, linestring in zip(todo, results):
+                cache[key] = linestring
+
+    # Only keep entries that are still in use.
+    cache = {keys[t]: cache[keys[t]] for t in tracks}
+    os.makedirs(os.path.dirname(linestring_cache_file), exist_ok=True)
+    with open(linestring_cache_file, "wb") as cache_file:
+        pickle.dump(cache, cache_file)
+
+    return {t: cache[keys[t]] for t in tracks}
+
+# Finished <LineString>s by gpx file name, see generate_linestrings().
+linestrings = {}
 
 # Put elements that we visited already into sets to check that we don't have duplicates.
 encountered_titles = set()
 encountered_dates = set()
 encountered_strava_urls = set()
 
-def generate_placemark(outing):
-    num_points = len(outing["points"]) if ("points" in outing) else 0
-    num_tracks = len(outing["tracks"]) if ("tracks" in outing) else 0
+outing_keys = {"date", "type", "title", "points", "tracks", "photoUrl", "stravaUrl", "note"}
+
+# A validated entry of the input json.
+@dataclass
+class Outing:
+    date: str
+    type: str
+    title: str
+    points: list
+    tracks: list
+    photo_url: Optional[str]
+    strava_urls: list
+    note: Optional[str]
+
+# Checks a json entry and fills in the date, type, and title from the track
+# file names where they're not given explicitly. Must be called for all
+# outings in order (before any placemark is written) for the duplicate checks.
+def parse_outing(outing) -> Outing:
+    assert(set(outing) <= outing_keys), f"Unknown keys {set(outing) - outing_keys}: {outing}"
+    points = outing.get("points", [])
+    tracks = outing.get("tracks", [])
+    date_str = activity_type = title = ""
 
     # Extract date, type, and title from the first available track.
-    if num_tracks > 0:
-        matches = re.search(track_file_format, outing["tracks"][0])
-        assert(matches), f'Gpx file name cannot be regex matched: {outing["tracks"][0]}'
-        assert(len(matches.groups()) == 4 or len(matches.groups()) == 5), f'Gpx file format incorrect: {outing["tracks"][0]}'
+    if len(tracks) > 0:
+        matches = track_file_re.search(tracks[0])
+        assert(matches), f'Gpx file name cannot be regex matched: {tracks[0]}'
+        assert(len(matches.groups()) == 4 or len(matches.groups()) == 5), f'Gpx file format incorrect: {tracks[0]}'
         date_str = matches.group(1)
         activity_type = matches.group(2)
         title = matches.group(3)
 
         # Make sure multi tracks are named the same way.
-        if num_tracks > 1:
-            assert matches.group(4), f'Wrong multi track format: {outing["tracks"][0]}'
+        if len(tracks) > 1:
+            assert matches.group(4), f'Wrong multi track format: {tracks[0]}'
         if matches.group(4):
-            assert(matches.group(4) == "1"), f'The first multi track files must have a "__1" suffix: {outing["tracks"]}'
-            for i, out in enumerate(outing["tracks"]):
-                assert(out == f"{date_str}__{activity_type}__{title}__{i + 1}.gpx"), f"Wrong multi track format: {out}"
+            assert(matches.group(4) == "1"), f'The first multi track files must have a "__1" suffix: {tracks}'
+            for i, track in enumerate(tracks):
+                assert(track == f"{date_str}__{activity_type}__{title}__{i + 1}.gpx"), f"Wrong multi track format: {track}"
 
         title = title.replace("_", " ")
 
-
     # Overwrite date, type, or title if explicitly specified
-    if "date" in outing:
-        date_str = outing["date"]
-    if "type" in outing:
-        activity_type = outing["type"]
-    if "title" in outing:
-        title = outing["title"]
+    date_str = outing.get("date", date_str)
+    activity_type = outing.get("type", activity_type)
+    title = outing.get("title", title)
 
     if title in encountered_titles:
         print(f"NOTE: Already encountered title: {title}")
@@ -201,84 +347,104 @@ def generate_placemark(outing):
     encountered_titles.add(title)
     encountered_dates.add(date_str)
 
-    assert((len(title) > 0) and (activity_type in styles) and re.search(f"^{date_fmt}$", date_str)), f"Every outing needs a valid title, type, and date: {outing}"
-    assert (num_points + num_tracks) > 0, f"An outing needs at least one track or point: {outing}"
+    assert((len(title) > 0) and (activity_type in styles) and date_re.search(date_str)), f"Every outing needs a valid title, type, and date: {outing}"
+    year, month, day = int(date_str[:4]), int(date_str[5:7]), int(date_str[8:10])
+    assert((1 <= month <= 12) and (1 <= day <= calendar.monthrange(year, month)[1])), f"Invalid date: {date_str}"
+    assert (len(points) + len(tracks)) > 0, f"An outing needs at least one track or point: {outing}"
+
+    for point in points:
+        assert((("lat" in point) and (type(point["lat"]) == float)) and
+               (("long" in point) and (type(point["long"]) == float)) and
+               (len(point) == 2)), f"Every point needs exactly 'lat' and 'long': {point}"
+
+    strava_urls = outing.get("stravaUrl", [])
+    assert(("stravaUrl" not in outing) or (len(strava_urls) > 0)), f"A 'stravaUrl' entry cannot be empty: {outing}"
+    for url in strava_urls:
+        assert(url not in encountered_strava_urls), f"Already encountered Strava URL: {url}"
+        encountered_strava_urls.add(url)
+
+    return Outing(date=date_str, type=activity_type, title=title, points=points, tracks=tracks,
+                  photo_url=outing.get("photoUrl"), strava_urls=strava_urls, note=outing.get("note"))
+
+def load_outings(json_file_name):
+    with open(json_file_name, "rb") as in_file:
+        if json_file_name.endswith(".ndjson"):
+            for line in in_file:
+                if line.strip():
+                    yield orjson.loads(line)
+        else:
+            yield from orjson.loads(in_file.read())
 
+def write_placemark(kml_file, outing: Outing):
     # Title, type, and date
     # NOTE: A <time> tag unfortunately gets not shown in the popover in the
     # non-<iframe> version.
-    date_formatted = date(int(date_str[:4]), int(date_str[5:7]), int(date_str[8:10]))
-    date_formatted = date_formatted.strftime("%B %d, %Y").replace(" 0", " ")
-    desc = f'<h4>{title}</h4><p>{activity_type} on {date_formatted}.</p>'
+    date_formatted = f"{month_names[int(outing.date[5:7]) - 1]} {int(outing.date[8:10])}, {outing.date[:4]}"
+    desc = f'<h4>{outing.title}</h4><p>{outing.type} on {date_formatted}.</p>'
 
     # Photo links
-    if ("photoUrl" in outing):
-        photo_url = outing["photoUrl"]
-        desc += f'<p>See <a href="{photo_base_url}{photo_url}" target="_blank">photos</a>.</p>'
+    if outing.photo_url is not None:
+        desc += f'<p>See <a href="{photo_base_url}{outing.photo_url}" target="_blank">photos</a>.</p>'
 
     # Strava links
-    if ("stravaUrl" in outing):
-        strava_urls = outing["stravaUrl"]
-        num_urls = len(strava_urls)
-        assert(num_urls > 0), f"A 'stravaUrl' entry cannot be empty: {outing}"
-        for url in strava_urls:
-            assert(url not in encountered_strava_urls), f"Already encountered Strava URL: {url}"
-            encountered_strava_urls.add(url)
-
-        if num_urls > 1:
-            strava_links = ", ".join(map(lambda i_url : f'<a href="{strava_base_url}{i_url[1]}" target="_blank">tracks {i_url[0] + 1}</a>', enumerate(strava_urls)))
-        else:
-            strava_links = f'<a href="{strava_base_url}{strava_urls[0]}" target="_blank">tracks</a>'
+    if len(outing.strava_urls) > 1:
+        strava_links = ", ".join(map(lambda i_url : f'<a href="{strava_base_url}{i_url[1]}" target="_blank">tracks {i_url[0] + 1}</a>', enumerate(outing.strava_urls)))
+        desc += f"<p>See tracks on Strava: {strava_links}.</p>"
+    elif len(outing.strava_urls) == 1:
+        strava_links = f'<a href="{strava_base_url}{outing.strava_urls[0]}" target="_blank">tracks</a>'
         desc += f"<p>See tracks on Strava: {strava_links}.</p>"
 
     # Notes
-    if ("note" in outing):
-        desc += f"<p>{outing['note']}</p>"
-
-    geom = ""
-    if num_points > 0:
-        def generate_point(point):
-            assert((("lat" in point) and (type(point["lat"]) == float)) and
-                   (("long" in point) and (type(point["long"]) == float)) and
-                   (len(point) == 2)), f"Every point needs exactly 'lat' and 'long': {point}"
-            coord = template_coordinate.format(long=point["long"], lat=point["lat"])
-            return template_point.format(coordinate=coord)
-        geom += "\n".join(map(generate_point, outing["points"]))
-
-    if num_tracks > 0:
-        def generate_linestring(track):
-            gpx_file_name = gpx_data_dir + track
-            with open(gpx_file_name, "r", encoding="utf8") as gpx_file:
-                gpx = gpxpy.parse(gpx_file)
-            assert((len(gpx.tracks) == 1) and
-                   (len(gpx.waypoints) == 0) and
-                   (len(gpx.routes) == 0)), f"We expect exactly 1 track per gpx file: {gpx_file_name}"
-
-            # Concat all points in all segments
-            assert(len(gpx.tracks[0].segments) == 1)
-            #all_points = [p for s in gpx.tracks[0].segments for p in s.points]
-            all_points = optimize_segment_rdp(gpx.tracks[0].segments[0]).points
-            coords = " ".join(map(lambda p : template_coordinate.format(long=p.longitude, lat=p.latitude), all_points))
-            return template_linestring.format(coordinates=coords)
-        geom += "\n".join(map(generate_linestring, outing["tracks"]))
-
-    if (num_points + num_tracks) > 1:
-        geom = indent(geom, 1)
-        geom = template_multigeometry.format(geometries=geom)
-    geom = indent(geom, 1)
-
-    return template_placemark.format(style_name=activity_type, description=desc, geometry=geom)
-
-try:
-    kml_placemarks = "\n".join(map(generate_placemark, outings))
-
-    kml_styles = indent(kml_styles, 2)
-    kml_placemarks = indent(kml_placemarks, 2)
-    kml_all = template_body.format(kml_title=kml_title, styles=kml_styles, placemarks=kml_placemarks)
-
-    with open(ouptut_kml_file, "w", encoding="utf8") as out_file:
-        out_file.write(kml_all)
-except AssertionError as error_msg:
-    print("ERROR: " + error_msg)
-    print("Aborting ...")
+    if outing.note is not None:
+        desc += f"<p>{outing.note}</p>"
+
+    geoms = []
+    for point in outing.points:
+        coord = template_coordinate % (point["long"], point["lat"])
+        geoms.append(template_point_begin + coord + template_point_end)
+    geoms += map(lambda track : linestrings[track], outing.tracks)
+
+    is_multi = len(geoms) > 1
+    kml_file.write(template_placemark_begin.format(style_name=outing.type, description=desc))
+    if is_multi:
+        kml_file.write(template_multigeometry_begin)
+    for geom in geoms:
+        write_indented(kml_file, geom, 4 if is_multi else 3)
+    if is_multi:
+        kml_file.write(template_multigeometry_end)
+    kml_file.write(template_placemark_end)
+
+if __name__ == "__main__":
+    try:
+        # NOTE: All outings are needed up front anyway to process their tracks
+        # in parallel, but at least the raw json isn't kept around.
+        outings = list(map(parse_outing, load_outings(input_json_file)))
+
+        all_tracks = list(dict.fromkeys(t for o in outings for t in o.tracks))
+        linestrings.update(generate_linestrings(all_tracks))
+
+        # Write into a temporary file first to not leave a half-written kml
+        # behind if one of the outings is invalid.
+        # NOTE: A large buffer since the placemarks are written in many small
+        # pieces.
+        with open(ouptut_kml_file + ".tmp", "w", encoding="utf8", buffering=1 << 20) as out_file:
+            out_file.write(template_header.format(kml_title=kml_title))
+            out_file.write(kml_styles)
+            for outing in outings:
+                write_placemark(out_file, outing)
+            out_file.write(template_footer)
+        os.replace(ouptut_kml_file + ".tmp", ouptut_kml_file)
+
+        # Fixed timestamp so that the kmz only changes when the kml does.
+        doc_info = zipfile.ZipInfo("doc.kml", date_time=(1980, 1, 1, 0, 0, 0))
+        doc_info.compress_type = zipfile.ZIP_DEFLATED
+        with zipfile.ZipFile(output_kmz_file, "w") as kmz_file, \
+             kmz_file.open(doc_info, "w") as doc_file, \
+             open(ouptut_kml_file, "rb") as kml_file:
+            shutil.copyfileobj(kml_file, doc_file)
+    except AssertionError as error_msg:
+        if os.path.exists(ouptut_kml_file + ".tmp"):
+            os.remove(ouptut_kml_file + ".tmp")
+        print(f"ERROR: {error_msg}")
+        print("Aborting ...")
 